@@ -6,6 +6,8 @@ import os
 import re
 import sys
 
+OUT_BUFFER_SIZE = 1 << 20
+
 
 # def get_nb_kmers(mfur_line):
 #     p = mfur_line.split("\t")
@@ -15,8 +17,8 @@ import sys
 
 def keep_fname(mfur_fname):
     filename_with_extension = os.path.basename(mfur_fname)  # Remove the path
-    filename_without_extension, _, _, = filename_with_extension.partition(".") # Remove extension (first dot)
-    return "_" + filename_without_extension
+    filename_without_extension, _, _, = filename_with_extension.partition(b".") # Remove extension (first dot)
+    return b"_" + filename_without_extension
 
 #convert mfur to COBS output format
 def process_mfur_output(hits_to_keep):
@@ -24,31 +26,44 @@ def process_mfur_output(hits_to_keep):
 
     Tempororary solution to avoid modifications in 'filter_queries.py'
     """
-    prev_query = ""
-    for x in sys.stdin:
-        query, filename, score = x.split("\t")
-        
+    write = sys.stdout.buffer.write
+    out = bytearray()  # output buffer, flushed every OUT_BUFFER_SIZE bytes
+    prev_query = None
+    prev_filename = None
+    i = 0  # match-counter
+    min_kmers = 0
+    for x in sys.stdin.buffer:
+        t1 = x.find(b"\t")
+        t2 = x.find(b"\t", t1 + 1)
+        query = x[:t1]
+
         # 1. Check if the line is related to a different query
         if query != prev_query:
-            print("*" + query) #the n. of matches can be ignored (not used later)
-            #print("*" + query, end="") #needed only if query-name contains "\n"
+            out += b"*" + query + b"\n"  #the n. of matches can be ignored (not used later)
             prev_query = query
             i = 0
 
         # 2. Check if matches were found for the query
-        if filename != "NA": 
-            i += 1 #increase match-counter
-            fname_only = keep_fname(filename) #clean matched filename
-
-            # 3. Extract the Top N results (+ties)
-            if i < hits_to_keep:
-                print(fname_only + "\t" + score, end="")
-            elif i == hits_to_keep:
-                print(fname_only + "\t" + score, end="")
-                min_kmers = int(score)
-            else:
-                if int(score) == min_kmers:
-                    print(fname_only + "\t" + score, end="")
+        filename = x[t1 + 1:t2]
+        if filename == b"NA":
+            continue
+        i += 1
+
+        # 3. Extract the Top N results (+ties)
+        score = x[t2 + 1:]
+        if i > hits_to_keep and int(score) != min_kmers:
+            continue
+        if i == hits_to_keep:
+            min_kmers = int(score)
+        if filename != prev_filename:
+            prev_filename = filename
+            fname_only = keep_fname(filename) + b"\t"  #clean matched filename
+        out += fname_only
+        out += score
+        if len(out) >= OUT_BUFFER_SIZE:
+            write(out)
+            out.clear()
+    write(out)
 
 
 def main():
@@ -3,10 +3,15 @@
 import argparse
 import atexit
 import collections
+import heapq
+import mmap
 import os
 import re
+import stat
 import sys
 
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
 from xopen import xopen
 
 from pathlib import Path
@@ -23,6 +28,82 @@ Approach:
     - keep just top k scores
 """
 
+CHUNK_SIZE = 4 * 1024 * 1024
+COBS_MATCH_RE = re.compile(rb"^[^_\n]*_([^\t\n]*)\t([0-9]+)", re.MULTILINE)
+
+COMPRESSED_SUFFIXES = (".gz", ".bz2", ".xz", ".zst")
+
+# only the head of a match file is prefetched, the kernel readahead follows the
+# sequential reads from there; this bounds what a prefetch can evict
+WILLNEED_BYTES = 64 * 1024 * 1024
+
+# matches are kept as single ints: kmers << KMERS_SHIFT | batch_id << REF_BITS | ref_id
+REF_BITS = 32
+BATCH_BITS = 24
+KMERS_SHIFT = REF_BITS + BATCH_BITS
+REF_MASK = (1 << REF_BITS) - 1
+BATCH_MASK = (1 << BATCH_BITS) - 1
+
+
+def fadvise(fn, advice, length=0):
+    """Give the kernel an access-pattern hint for a file.
+
+    The advice is issued on a separate file descriptor, so only page-cache
+    wide hints (WILLNEED, DONTNEED) are useful. No-op where unsupported and
+    for anything but regular files (e.g. "-" for stdin, pipes); errors are
+    ignored, as a hint must never stop the processing.
+
+    Args:
+        fn (str): File name.
+        advice (str): Name of the advice, without the POSIX_FADV_ prefix.
+        length (int): Number of bytes from the start of the file, 0 for all.
+    """
+    if not hasattr(os, "posix_fadvise") or fn == "-":
+        return
+    try:
+        if not stat.S_ISREG(os.stat(fn).st_mode):
+            return
+        fd = os.open(fn, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, length, getattr(os, f"POSIX_FADV_{advice}"))
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _symbol_id(table, ids, symbol):
+    i = ids.get(symbol)
+    if i is None:
+        i = ids[symbol] = len(table)
+        table.append(symbol)
+    return i
+
+
+class RefIds(dict):
+    """Ids of refs, numbered on their first lookup.
+
+    Shared by the queries of a Sift, so that a kept ref is stored once.
+
+    Attributes:
+        table (list): The refs by id.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.table = []
+
+    def __missing__(self, ref):
+        i = self[ref] = len(self.table)
+        self.table.append(ref)
+        return i
+
+
+def batch_name(cobs_matches_fn):
+    return os.path.basename(cobs_matches_fn).split("____")[0]
+
 
 def cobs_iterator(cobs_matches_fn):
     """Iterator for cobs matches.
@@ -30,40 +111,61 @@ def cobs_iterator(cobs_matches_fn):
     Assumes that cobs ref names start with a random sorting prefix followed by
     an underscore (embedded by Leandro).
 
+    The file is read as raw bytes in large chunks, which are split into query
+    blocks; the matches of each block are then extracted at once by a compiled
+    regex, so that no Python code runs per line.
+
     Args:
         cobs_matches_fn (str): File name of cobs output.
 
     Returns:
-        (qname, matches): Qname and list of assignments of the same query, in the form (ref, kmers)
+        (qname, batch, matches): Qname, batch and list of assignments of the
+            same query, in the form (ref, kmers) with ref as bytes and kmers as
+            int
 
     Todo:
         - if necessary in the future, add batch name from the file name
     """
-    qname = None
-    matches_buffer = []
-    batch = os.path.basename(cobs_matches_fn).split("____")[0]
+    batch = batch_name(cobs_matches_fn)
     print(f"Translating matches {cobs_matches_fn}", file=sys.stderr)
-    with xopen(cobs_matches_fn) as f:
-        for x in f:
-            x = x.strip()
-            if not x:
-                continue
-            if x[0] == "*":
-                ## HEADER
-                # empty buffer
-                if qname is not None:
-                    yield qname, batch, matches_buffer
-                    matches_buffer = []
-                # parse header
-                parts = x[1:].split("\t")
-                qname = parts[0].split(" ")[0]  # remove fasta comments
-                nmatches = int(parts[1])
+    # the file is read once, linearly: prefetch its head and drop it from the page cache afterwards
+    fadvise(cobs_matches_fn, "WILLNEED", WILLNEED_BYTES)
+    with xopen(cobs_matches_fn, "rb") as f:
+        # pieces of the text not parsed yet, which starts at a query block
+        # boundary: every query block is then preceded by "\n*"
+        pending = [b"\n"]
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if chunk:
+                # only the new chunk is searched, so that a query block larger
+                # than a chunk is not scanned again with every chunk
+                cut = chunk.rfind(b"\n*")
+                if cut == -1 and chunk[:1] == b"*" and pending[-1][-1:] == b"\n":
+                    # boundary across the chunks
+                    pending[-1] = pending[-1][:-1]
+                    chunk = b"\n" + chunk
+                    cut = 0
+                if cut == -1:
+                    pending.append(chunk)
+                    continue
+                pending.append(memoryview(chunk)[:cut])
+                text = b"".join(pending)
+                pending = [chunk[cut:]]  # possibly incomplete last query
             else:
-                ## MATCH
-                tmp_name, kmers = x.split()
-                rid, ref = tmp_name.split("_")
-                matches_buffer.append((ref, kmers))
-    yield qname, batch, matches_buffer
+                text = b"".join(pending)
+            for x in text.split(b"\n*")[1:]:
+                ## HEADER
+                # parse header, removing fasta comments
+                eol = x.find(b"\n")
+                if eol == -1:
+                    eol = len(x)
+                qname = x[:eol].partition(b"\t")[0].partition(b" ")[0].decode()
+                ## MATCHES
+                matches = [(ref, int(kmers)) for ref, kmers in COBS_MATCH_RE.findall(x, eol)]
+                yield qname, batch, matches
+            if not chunk:
+                break
+    fadvise(cobs_matches_fn, "DONTNEED")
 
 
 def readfq(fp):  # this is a generator function
@@ -102,95 +204,241 @@ def readfq(fp):  # this is a generator function
                 break
 
 
+def readfq_offsets(buf):
+    """Iterator over fasta/q records, without copying the sequences.
+
+    Follows https://github.com/lh3/readfq/blob/master/readfq.py, but scans raw
+    bytes as a single state machine.
+
+    Args:
+        buf (mmap.mmap or bytes): Content of a fasta/q file.
+
+    Returns:
+        (name, start, end): Name and byte range of the sequence lines in buf
+    """
+    n = len(buf)
+    find = buf.find
+    pos = 0
+    name = None
+    start = end = seqlen = 0
+    qual = -1  # quality length still to skip in a fastq record, -1 outside of qualities
+    while pos < n:
+        eol = find(b"\n", pos)
+        if eol == -1:
+            eol = n
+        # end of the line content, "\r\n" line ends are read as in text mode
+        stop = eol - 1 if eol > pos and buf[eol - 1] == 13 else eol
+        if qual >= 0:
+            qual -= stop - pos
+            if qual <= 0:  # have read enough quality
+                yield name, start, end
+                name, qual = None, -1
+        else:
+            c = buf[pos] if stop > pos else 10
+            if c == 62 or c == 64:  # ">" or "@"
+                if name is not None:
+                    yield name, start, end
+                name = buf[pos + 1:stop].decode().partition(" ")[0]
+                start = end = seqlen = 0
+            elif name is None:  # search for the start of the next record
+                pass
+            elif c == 43:  # "+", this is a fastq record
+                qual = seqlen
+            else:
+                if seqlen == 0:
+                    start = pos
+                end = stop
+                seqlen += stop - pos
+        pos = eol + 1
+    if name is not None:  # incl. EOF before reading enough quality
+        yield name, start, end
+
+
+class MappedSeq:
+    """A sequence left in the query file buffer until it is printed.
+
+    Args:
+        mm (mmap.mmap or bytes): Content of the fasta/q file.
+        start (int): Offset of the first sequence line.
+        end (int): Offset of the end of the last sequence line.
+    """
+
+    __slots__ = ("_mm", "_start", "_end")
+
+    def __init__(self, mm, start, end):
+        self._mm = mm
+        self._start = start
+        self._end = end
+
+    def __str__(self):
+        return self._mm[self._start:self._end].replace(b"\n", b"").replace(b"\r", b"").decode()
+
+
 class SingleQuery:
     """A simple optimized buffer for keeping top matches for a single read accross batches.
 
     Args:
         keep_matches (int): The number of top matches to keep.
+        ref_ids (RefIds): Ids of the refs of the packed matches.
 
 
     Attributes:
-        _matches (list): A list of (ref, kmers)
+        _heap (list): A min-heap of the top matches, packed as ints (kmers in
+            the high bits, see KMERS_SHIFT)
+        _ties (list): Packed matches beyond keep_matches tied with the heap
+            minimum
     """
 
-    def __init__(self, qname, seq, keep_matches):
+    def __init__(self, qname, seq, keep_matches, ref_ids):
         self._keep_matches = keep_matches
-        self._min_matching_kmers = 0  #should be increased once the number of records >keep
-        self._matches = []
+        self._ref_ids = ref_ids
+        self._min_matching_kmers = 0  #should be increased once the number of records >=keep
+        self._heap = []
+        self._ties = []
         self._qname = qname
         self._seq = seq
 
-    def add_matches(self, batch, matches):
+    def add_matches(self, batch_id, matches):
         """Add matches.
         """
-        for mtch in matches:
-            ref, kmers = mtch
-            kmers = int(kmers)
-            if kmers >= self._min_matching_kmers:
-                self._matches.append((batch, ref, kmers))
-        self._housekeeping()
-
-    def _housekeeping(self):
-        # 1. sort and exit if not full
-        self._matches.sort(key=lambda x: (-x[2], x[0], x[1]))
-
-        # 2. separate losers
-        losers = self._matches[self._keep_matches:]
-        self._matches = self._matches[:self._keep_matches]
-
-        # 3. return back tie records from losers
-        if losers:
-            #get the tie value
-            self._min_matching_kmers = self._matches[-1][2]
-            for x in losers:
-                if x[2] == self._min_matching_kmers:
-                    #print(f"Returning {x}", file=sys.stderr)
-                    self._matches.append(x)
+        heap = self._heap
+        keep = self._keep_matches
+        if keep <= 0:
+            return
+
+        batch_bits = batch_id << REF_BITS
+        ref_ids = self._ref_ids
+
+        # 1. fill the buffer, it becomes a heap once full
+        if len(heap) < keep:
+            n = keep - len(heap)
+            heap += [kmers << KMERS_SHIFT | batch_bits | ref_ids[ref] for ref, kmers in matches[:n]]
+            if len(heap) < keep:
+                return
+            matches = matches[n:]
+            heapq.heapify(heap)
+            self._min_matching_kmers = heap[0] >> KMERS_SHIFT
+
+        # 2. replace the minimum, or keep the match as a tie; a ref is numbered
+        # only once its match passes the threshold
+        for ref, kmers in matches:
+            if kmers < self._min_matching_kmers:
+                continue
+            record = kmers << KMERS_SHIFT | batch_bits | ref_ids[ref]
+            if kmers == self._min_matching_kmers:
+                self._ties.append(record)
+            else:
+                loser = heapq.heapreplace(heap, record)
+                if heap[0] >> KMERS_SHIFT == loser >> KMERS_SHIFT:
+                    self._ties.append(loser)
                 else:
-                    break
+                    # the threshold advanced, all the previous ties are losers
+                    self._min_matching_kmers = heap[0] >> KMERS_SHIFT
+                    self._ties = []
+
+    def sorted_matches(self):
+        """Top matches (+ties) as (batch_id, ref, kmers), best first.
+        """
+        ref_table = self._ref_ids.table
+        top = [(x >> KMERS_SHIFT, x >> REF_BITS & BATCH_MASK, ref_table[x & REF_MASK])
+               for x in self._heap + self._ties]
+        # no Python key function: natural tuple order, then a stable C-level
+        # sort by decreasing kmers keeps batch and ref ascending within ties
+        top.sort()
+        top.sort(key=itemgetter(0), reverse=True)
+        return [(batch_id, ref, kmers) for kmers, batch_id, ref in top]
 
     def fasta_record_matches(self):
         name = self._qname
-        com = ",".join([x[1] for x in self._matches])
+        com = b",".join([x[1] for x in self.sorted_matches()]).decode()
         seq = self._seq
         return f">{name} {com}\n{seq}"
 
 
+def collect_cobs_records(cobs_fn, keep_matches):
+    """Top matches (+ties) of every query in a single cobs file.
+
+    Meant to be run in a worker process, so that only the reduced records
+    (rather than all the matches) are sent back to the parent.
+
+    Args:
+        cobs_fn (str): File name of cobs output.
+        keep_matches (int): The number of top matches to keep.
+
+    Returns:
+        list: (qname, batch, matches) records as produced by cobs_iterator
+    """
+    ref_ids = RefIds()  # per file, only the refs themselves are sent back
+    records = []
+    for qname, batch, matches in cobs_iterator(cobs_fn):
+        sq = SingleQuery(qname=qname, seq=None, keep_matches=keep_matches, ref_ids=ref_ids)
+        sq.add_matches(0, matches)  # a single batch per file
+        records.append((qname, batch, [(ref, kmers) for _, ref, kmers in sq.sorted_matches()]))
+    return records
+
+
 class Sift:
     """Sifting class for all reported cobs assignments.
+
+    Args:
+        batches (list): Names of the expected batches. They get ids in sorted
+            order, so that matches are sorted by batch name through their ids.
     """
 
-    def __init__(self, query_fn, keep_matches):
+    def __init__(self, query_fn, keep_matches, batches=()):
         self._query_fn = query_fn
         self._keep_matches = keep_matches
+        self._batches = sorted(set(batches))
+        self._batch_ids = {batch: i for i, batch in enumerate(self._batches)}
+        self._ref_ids = RefIds()
         #self._query_dict = collections.OrderedDict()
-        self._query_dict = self._create_query_dict(query_fn, keep_matches)
+        self._query_dict = self._create_query_dict(query_fn, keep_matches, self._ref_ids)
 
     @staticmethod
-    def _create_query_dict(fx_fn, keep_matches):
+    def _create_query_dict(fx_fn, keep_matches, ref_ids):
         d = collections.OrderedDict()
-        with xopen(fx_fn) as fo:
-            for qname, seq, _ in readfq(fo):
-                d[qname] = SingleQuery(qname=qname, keep_matches=keep_matches, seq=seq)
+        if os.path.isfile(fx_fn) and os.path.getsize(fx_fn) > 0 and not fx_fn.endswith(COMPRESSED_SUFFIXES):
+            # keep only offsets of the sequences, they are read again when printed
+            with open(fx_fn, "rb") as fo:
+                mm = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+            for qname, start, end in readfq_offsets(mm):
+                d[qname] = SingleQuery(qname=qname, keep_matches=keep_matches, seq=MappedSeq(mm, start, end),
+                                       ref_ids=ref_ids)
+        else:
+            # compressed, empty, or not a regular file (e.g. "-" for stdin): stream
+            # the records, keeping only their sequences in memory
+            with xopen(fx_fn) as fo:
+                for qname, seq, _ in readfq(fo):
+                    d[qname] = SingleQuery(qname=qname, keep_matches=keep_matches, seq=seq, ref_ids=ref_ids)
         #pprint(d)
         return d
 
     def process_cobs_file(self, cobs_fn):
-        for i, (qname, batch, matches) in enumerate(cobs_iterator(cobs_fn)):
+        self.add_cobs_records(cobs_iterator(cobs_fn))
+
+    def add_cobs_records(self, records):
+        """Merge records from cobs_iterator or collect_cobs_records.
+        """
+        query_dict = self._query_dict
+        keep_matches = self._keep_matches
+        for i, (qname, batch, matches) in enumerate(records):
             print(f"Processing batch {batch} query #{i} ({qname})", file=sys.stderr)
-            try:
-                _ = self._query_dict[qname]
-            except KeyError:
-                self._query_dict[qname] = SingleQuery(qname, self._keep_matches)
-            self._query_dict[qname].add_matches(batch, matches)
+            batch_id = self._batch_ids.get(batch)
+            if batch_id is None:
+                batch_id = _symbol_id(self._batches, self._batch_ids, batch)
+            sq = query_dict.get(qname)
+            if sq is None:
+                sq = query_dict[qname] = SingleQuery(qname=qname, seq="", keep_matches=keep_matches,
+                                                       ref_ids=self._ref_ids)
+            sq.add_matches(batch_id, matches)
 
     def print_tsv_summary(self):
         d = self._query_dict
         for q in d:
             #print(q, d[q]._matches)
             #pass
-            for mtch in d[q]._matches:
-                print(q, *mtch, sep="\t")
+            for batch_id, ref, kmers in d[q].sorted_matches():
+                print(q, self._batches[batch_id], ref.decode(), kmers, sep="\t")
 
     def print_fa(self):
         d = self._query_dict
@@ -199,10 +447,17 @@ class Sift:
             print(frm)
 
 
-def process_files(query_fn, match_fns, keep_matches):
-    sift = Sift(keep_matches=keep_matches, query_fn=query_fn)
-    for fn in match_fns:
-        sift.process_cobs_file(fn)
+def process_files(query_fn, match_fns, keep_matches, threads):
+    sift = Sift(keep_matches=keep_matches, query_fn=query_fn, batches=[batch_name(fn) for fn in match_fns])
+    if threads == 1:
+        for fn in match_fns:
+            sift.process_cobs_file(fn)
+    else:
+        chunksize = max(1, len(match_fns) // (threads * 4))
+        with ProcessPoolExecutor(max_workers=min(threads, len(match_fns))) as ex:
+            for records in ex.map(collect_cobs_records, match_fns, [keep_matches] * len(match_fns),
+                                  chunksize=chunksize):
+                sift.add_cobs_records(records)
     sift.print_fa()
 
 
@@ -234,8 +489,19 @@ def main():
         help=f'no. of best hits to keep [{DEFAULT_KEEP}]',
     )
 
+    parser.add_argument(
+        '-t',
+        metavar='int',
+        dest='threads',
+        type=int,
+        default=1,
+        help=f'no. of worker processes parsing the match files [1]',
+    )
+
     args = parser.parse_args()
-    process_files(args.query_fn, args.match_fn, args.keep)
+    if args.threads < 1:
+        parser.error(f"-t must be at least 1, got {args.threads}")
+    process_files(args.query_fn, args.match_fn, args.keep, args.threads)
 
 
 if __name__ == "__main__":
@@ -53,13 +53,13 @@ def _get_batch_name(st):
 
 def get_match(st):
     #print(st)
-    p = st.split("\t")
+    p = st.split(b"\t", 3)
     qname = p[0]
     rname = p[2]
-    if rname == "*":
+    if rname == b"*":
         return qname, None, None
     else:
-        accession, _, contig = rname.partition(".")
+        accession, _, contig = rname.partition(b".")
         return qname, accession, contig
 
 
@@ -82,6 +82,7 @@ def compute_stats(results_fn, queries_fn):
 
     if queries_fn is not None:
         queries, queries_bps = load_query_names_and_bps(queries_fn)
+        queries = {q.encode() for q in queries}  # the results are parsed as bytes
     else:
         queries = None
 
@@ -90,15 +91,20 @@ def compute_stats(results_fn, queries_fn):
     nb_alignments = 0
     nb_nonalignments = 0
 
-    with xopen(results_fn) as fo:
+    with xopen(results_fn, "rb") as fo:
         for x in fo:
-            x = x.strip()
-            # 1) empty line
-            if not x:
-                continue
+            # no strip: the line end only ends up in the unused fourth field
+            c = x[0]
+            # 1) empty line, incl. whitespace-only ones; a line starting with
+            # whitespace (rare) is stripped, as before
+            if c in (10, 13, 32, 9):  # "\n", "\r", " ", "\t"
+                x = x.strip()
+                if not x:
+                    continue
+                c = x[0]
             # 2) header
-            if x[:2] == "==":
-                batch = _get_batch_name(x)
+            if c == 61 and x[:2] == b"==":  # "="
+                batch = _get_batch_name(x.rstrip().decode())
                 print(batch, "", file=sys.stderr)
             # 3) content line
             else:
@@ -109,7 +115,7 @@ def compute_stats(results_fn, queries_fn):
                     nb_alignments += 1
                     batches.add(batch)
                     refs.add(accession)
-                    query_ref_pairs.add(f"{accession}__{qname}")
+                    query_ref_pairs.add(accession + b"__" + qname)
                 else:  # b) unaligned
                     nb_nonalignments += 1
     print(file=sys.stderr)
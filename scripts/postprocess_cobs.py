@@ -8,35 +8,36 @@ import sys
 
 
 def get_nb_kmers(cobs_line):
-    p = cobs_line.split("\t")
-    nb_kmers = int(p[-1])
+    _, _, r = cobs_line.rpartition(b"\t")
+    nb_kmers = int(r)
     return nb_kmers
 
 
 def remove_rnd_id(cobs_line):
-    _, _, r = cobs_line.partition("_")
-    return "_" + r
+    _, _, r = cobs_line.partition(b"_")
+    return b"_" + r
 
 
 def process_cobs_output(hits_to_keep):
-    for x in sys.stdin:
-        if x[0] == "*":
+    write = sys.stdout.buffer.write
+    for x in sys.stdin.buffer:
+        if x[0] == 42:  # ord("*")
             i = 0
-            print(x, end="")
+            write(x)
             min_kmers = 0
         else:
             y = remove_rnd_id(x)
             i += 1
 
             if i < hits_to_keep:
-                print(y, end="")
+                write(y)
             elif i == hits_to_keep:
-                print(y, end="")
+                write(y)
                 min_kmers = get_nb_kmers(y)
             else:
                 kmers = get_nb_kmers(y)
                 if kmers == min_kmers:
-                    print(y, end="")
+                    write(y)
 
 
 def main():